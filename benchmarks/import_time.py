@@ -0,0 +1,46 @@
+""" Measure how long importing vertebrae takes, and which modules it pulls in
+
+    python benchmarks/import_time.py [module] [--top 15]
+"""
+import argparse
+import subprocess
+import sys
+
+HEAVY = ('boto3', 'botocore', 'aiopg', 'psycopg2', 'aioredis', 'jinja2', 'aiohttp_jinja2', 'aiohttp_cors',
+         'detect_probe')
+REPEAT = 5
+
+
+def profile(module: str) -> dict:
+    """ Import a module in a fresh interpreter and return the cumulative microseconds of each module it loaded """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('module', nargs='?', default='vertebrae.core')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    runs = [profile(args.module) for _ in range(REPEAT)]
+    times = min(runs, key=lambda run: run[args.module])
+    print(f'{"import " + args.module:<40} {times[args.module] / 1000:>10.1f} ms (best of {REPEAT})')
+    print()
+    top = sorted(((t, name) for name, t in times.items() if '.' not in name and name != args.module), reverse=True)
+    for t, name in top[:args.top]:
+        print(f'{name:<40} {t / 1000:>10.1f} ms')
+    print()
+    loaded = [name for name in HEAVY if name in times]
+    print(f'{"heavy dependencies loaded":<40} {", ".join(loaded) or "none"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+""" Compare JSON request parsing and response encoding against the standard library
+
+    python benchmarks/json_serializer.py
+"""
+import asyncio
+import json
+import timeit
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from vertebrae import serializer
+from vertebrae.core import strip_request, json_response
+
+PAYLOAD = dict(text='hi, there', tags=[f'tag-{i}' for i in range(50)],
+               items=[dict(id=i, name=f'item {i}', price=i * 1.5, active=i % 2 == 0) for i in range(200)])
+NUMBER = 2000
+
+
+async def stdlib_strip_request(request: web.Request):
+    """ strip_request as it was before vertebrae.serializer """
+    data = dict(request.match_info) | dict(request.rel_url.query)
+    try:
+        data.update(dict(await request.json()))
+    except json.JSONDecodeError:
+        pass
+    return data
+
+
+def request() -> web.Request:
+    req = make_mocked_request('POST', '/chat?page=1&size=20', headers={'Content-Type': 'application/json'})
+    req._read_bytes = json.dumps(PAYLOAD).encode('utf-8')
+    return req
+
+
+def measure(name: str, func) -> float:
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER
+    print(f'{name:<40} {seconds * 1e6:>10.1f} us')
+    return seconds
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    req = request()
+    print(f'serializer: {serializer.NAME}')
+    before = measure('strip_request (stdlib)', lambda: loop.run_until_complete(stdlib_strip_request(req)))
+    after = measure('strip_request', lambda: loop.run_until_complete(strip_request(req)))
+    print(f'{"speedup":<40} {before / after:>10.2f}x')
+    before = measure('web.json_response (stdlib)', lambda: web.json_response(PAYLOAD))
+    after = measure('json_response', lambda: json_response(PAYLOAD))
+    print(f'{"speedup":<40} {before / after:>10.2f}x')
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
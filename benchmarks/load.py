@@ -0,0 +1,88 @@
+""" A concurrent load generator, reporting latency percentiles and throughput
+
+    python benchmarks/load.py http://localhost:8079/ping -n 5000 -c 50
+    python benchmarks/load.py http://localhost:8079/chat -m POST -d '{"text": "hi"}' -H token=abc123
+"""
+import argparse
+import asyncio
+import math
+import time
+
+import aiohttp
+
+
+def percentile(ordered: list, q: float) -> float:
+    """ Nearest-rank percentile of an already sorted list """
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)] if ordered else 0.0
+
+
+def summarize(latencies: list, elapsed: float, errors=0) -> dict:
+    ordered = sorted(latencies)
+    return dict(requests=len(ordered), errors=errors, rps=len(ordered) / elapsed if elapsed else 0.0,
+                p50=percentile(ordered, 0.50) * 1000, p99=percentile(ordered, 0.99) * 1000)
+
+
+async def drive(call, requests=2000, concurrency=50, warmup=100) -> dict:
+    """ Await `call()` `requests` times from `concurrency` concurrent callers, after an unmeasured warmup """
+    await asyncio.gather(*(call() for _ in range(warmup)), return_exceptions=True)
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def caller():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                ok = await call()
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if ok is False:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+def http(session: aiohttp.ClientSession, method: str, url: str, **kwargs):
+    """ Build a call for `drive` that sends one request and reports whether it succeeded """
+    async def call():
+        async with session.request(method, url, **kwargs) as response:
+            await response.read()
+            return response.status < 400
+    return call
+
+
+def report(name: str, stats: dict) -> None:
+    print(f'{name:<24} {stats["requests"]:>8} {stats["errors"]:>7} {stats["rps"]:>10.0f} '
+          f'{stats["p50"]:>9.2f} {stats["p99"]:>9.2f}')
+
+
+def header() -> None:
+    print(f'{"benchmark":<24} {"requests":>8} {"errors":>7} {"req/s":>10} {"p50 ms":>9} {"p99 ms":>9}')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url')
+    parser.add_argument('-m', '--method', default='GET')
+    parser.add_argument('-d', '--data', help='request body, sent as application/json')
+    parser.add_argument('-H', '--header', action='append', default=[], help='name=value')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    headers = dict(h.split('=', 1) for h in args.header)
+    if args.data:
+        headers.setdefault('Content-Type', 'application/json')
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+        call = http(session, args.method, args.url, headers=headers, data=args.data)
+        stats = await drive(call, requests=args.requests, concurrency=args.concurrency)
+    header()
+    report(args.method, stats)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
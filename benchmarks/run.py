@@ -0,0 +1,244 @@
+""" Benchmark the framework hot paths against the sample application, offline
+
+    python benchmarks/run.py [--only ping,cache] [-n 2000] [-c 50]
+    python benchmarks/run.py --save benchmarks/baseline.json
+    python benchmarks/run.py --compare benchmarks/baseline.json [--tolerance 0.1]
+
+Redis and Postgres are replaced by in-process fakes and S3 by moto, unless --config points at an env.yml
+that configures real ones. Fakes measure the framework's own overhead, not the database.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+from pathlib import Path
+
+import aiohttp
+from aiohttp.test_utils import make_mocked_request
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'sample'))
+
+from load import drive, header, http, report
+from vertebrae import serializer
+from vertebrae.config import Config
+from vertebrae.core import Application, strip_request
+from vertebrae.service import Service
+
+TOKEN = 'abc123'
+PAYLOAD = serializer.dumps(dict(text='hi, there', tags=[f'tag-{i}' for i in range(20)]))
+
+
+class FakeRedis:
+    """ The subset of the Redis client used by the Cache store, kept in a dict """
+
+    def __init__(self):
+        self._data = dict()
+
+    async def get(self, k):
+        await asyncio.sleep(0)
+        return self._data.get(k)
+
+    async def mget(self, *keys):
+        await asyncio.sleep(0)
+        return [self._data.get(k) for k in keys]
+
+    async def set(self, k, v, ex=None):
+        await asyncio.sleep(0)
+        self._data[k] = v
+
+    async def delete(self, k):
+        await asyncio.sleep(0)
+        self._data.pop(k, None)
+
+    async def execute_command(self, command, k):
+        await asyncio.sleep(0)
+        if command == 'GETDEL':
+            return self._data.pop(k, None)
+
+    async def publish(self, channel, message):
+        await asyncio.sleep(0)
+
+    async def close(self):
+        pass
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, statement, params=None):
+        await asyncio.sleep(0)
+
+    async def fetchone(self):
+        return 1, 'row'
+
+    async def fetchall(self):
+        return [(i, f'row {i}') for i in range(10)]
+
+
+class FakeConnection:
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakePool:
+    """ An aiopg pool whose connections answer every query with the same rows """
+
+    def __init__(self, size=5):
+        self._free = asyncio.Queue()
+        for _ in range(size):
+            self._free.put_nowait(FakeConnection())
+
+    async def acquire(self):
+        return await self._free.get()
+
+    async def release(self, conn):
+        self._free.put_nowait(conn)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def connect_stores(mocks: list) -> None:
+    """ Connect the stores the benchmarks use, filling in a fake for any that is not configured """
+    cache, relational, s3 = Service.db('cache'), Service.db('relational'), Service.db('s3')
+    if not Config.find('aws'):
+        from moto import mock_aws
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        mocks.append(mock_aws())
+        mocks[-1].start()
+        Config.load({**Config._configs, 'aws': dict(region='us-east-1')})
+    await Service.db().connect()
+    if cache._cache is None:
+        cache._cache = FakeRedis()
+    if relational._pool is None:
+        relational._pool, relational._acquire_timeout = FakePool(), 10.0
+    if mocks:
+        s3.client.create_bucket(Bucket='vertebrae-bench')
+
+
+def scenarios(session: aiohttp.ClientSession, url: str) -> dict:
+    """ Name each benchmark and the call it repeats """
+    request = make_mocked_request('POST', '/chat?page=1', headers={'Content-Type': 'application/json'})
+    request._read_bytes = PAYLOAD
+
+    async def parse():
+        return bool(await strip_request(request))
+
+    async def cache():
+        await Service.db('cache').set('bench', 'value')
+        return await Service.db('cache').get('bench') == 'value'
+
+    async def relational():
+        return bool(await Service.db('relational').fetch('SELECT id, name FROM bench WHERE id > %s', (0,)))
+
+    async def s3():
+        await Service.db('s3').write('vertebrae-bench/bench.txt', b'value')
+        return await Service.db('s3').read('vertebrae-bench/bench.txt') is not None
+
+    headers = dict(token=TOKEN)
+    return dict(
+        ping=http(session, 'GET', f'{url}/ping'),
+        chat_post=http(session, 'POST', f'{url}/chat', data=PAYLOAD,
+                       headers={**headers, 'Content-Type': 'application/json'}),
+        chat_get=http(session, 'GET', f'{url}/chat', headers=headers),
+        strip_request=parse,
+        cache=cache,
+        relational=relational,
+        s3=s3,
+    )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """ Print each benchmark against the baseline and return whether any regressed beyond the tolerance """
+    regressed = False
+    print()
+    print(f'{"benchmark":<24} {"req/s":>10} {"p99 ms":>10}')
+    for name, stats in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            print(f'{name:<24} {"no baseline":>21}')
+            continue
+        rps = stats['rps'] / before['rps'] - 1 if before['rps'] else 0.0
+        p99 = stats['p99'] / before['p99'] - 1 if before['p99'] else 0.0
+        worse = rps < -tolerance or p99 > tolerance
+        regressed |= worse
+        print(f'{name:<24} {rps:>+10.1%} {p99:>+10.1%}{"  REGRESSION" if worse else ""}')
+    return regressed
+
+
+async def main(args) -> dict:
+    from app.routes.core_routes import CoreRoutes
+    from app.services.chat import ChatService
+
+    Config.load(Config.strip(env=args.config) if args.config else dict())
+    Config.load({**Config._configs, 'token': TOKEN})
+    chat = ChatService(name='chat')
+    Service.enroll(chat.log.name, chat)
+    mocks = []
+    await connect_stores(mocks)
+
+    port = free_port()
+    app = Application(port=port, routes=[CoreRoutes()], access_log=False)
+    app.attach_routes()
+    await app.start()
+    results = dict()
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            calls = scenarios(session, f'http://127.0.0.1:{port}')
+            header()
+            for name, call in calls.items():
+                if args.only and name not in args.only:
+                    continue
+                results[name] = await drive(call, requests=args.requests, concurrency=args.concurrency)
+                report(name, results[name])
+    finally:
+        await app.stop()
+        await Service.db().close()
+        for mock in mocks:
+            mock.stop()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', type=lambda v: v.split(','), help='comma separated benchmark names')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('--config', help='env.yml with real redis, postgres or aws settings')
+    parser.add_argument('--save', help='write results to this baseline file')
+    parser.add_argument('--compare', help='compare results with this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown before failing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(main(args))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(python=platform.python_version(), serializer=serializer.NAME, requests=args.requests,
+                           concurrency=args.concurrency, results=results), f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(results, json.load(f), args.tolerance) else 0)
@@ -1,7 +1,7 @@
 from aiohttp import web
 
 from app.authentication import allowed
-from vertebrae.core import Route
+from vertebrae.core import Route, json_response
 from vertebrae.service import Service
 
 
@@ -14,9 +14,9 @@ class CoreRoutes:
         ]
 
     @allowed
-    async def _get_messages(self, data: dict) -> web.json_response:
+    async def _get_messages(self, data: dict) -> web.Response:
         messages = await Service.find('chat').get_msgs()
-        return web.json_response(messages)
+        return json_response(messages)
 
     @allowed
     async def _save_message(self, data: dict) -> web.Response:
@@ -0,0 +1,86 @@
+import asyncio
+import collections
+from functools import wraps
+
+from aiohttp import web
+
+from vertebrae.metrics import Counter, Gauge, Metrics
+
+ACTIVE = Metrics.register(Gauge('vertebrae_admission_active', 'Requests holding an admission slot', ('limit',)))
+QUEUED = Metrics.register(Gauge('vertebrae_admission_queued', 'Requests waiting for an admission slot', ('limit',)))
+SHED = Metrics.register(Counter('vertebrae_admission_shed_total', 'Requests refused with 503',
+                                ('limit', 'reason')))
+
+
+class Limiter:
+    """ Run at most `concurrency` requests at once and queue up to `queue` more, answering the rest with 503
+
+    A queued request is shed as soon as it has waited `timeout` seconds, so callers get a fast Retry-After
+    instead of a slow timeout. One limiter can be shared by several routes to guard a common resource.
+    """
+
+    def __init__(self, concurrency=100, queue=100, timeout=1.0, retry_after=1, name=None):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.name = name
+        self._active = 0
+        self._waiters = collections.deque()
+        self._shed = 0
+
+    def wrap(self, handle):
+        """ Admit each request before the route handler runs """
+        @wraps(handle)
+        async def helper(request: web.Request):
+            if not await self.acquire():
+                return web.Response(status=503, headers={'Retry-After': str(self.retry_after)})
+            try:
+                return await handle(request)
+            finally:
+                self.release()
+        return helper
+
+    async def acquire(self) -> bool:
+        """ Take a slot, queueing for up to `timeout` seconds; False means the request should be shed """
+        if self._active < self.concurrency and not self._waiters:
+            self._active += 1
+            ACTIVE.inc((self.name,))
+            return True
+        if len(self._waiters) >= self.queue:
+            self._refuse('queue_full')
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        QUEUED.inc((self.name,))
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            self._refuse('timeout')
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            QUEUED.dec((self.name,))
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self) -> None:
+        """ Hand the slot to the longest waiting request, or free it """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+        ACTIVE.dec((self.name,))
+
+    def stats(self) -> dict:
+        return dict(active=self._active, queued=len(self._waiters), shed=self._shed)
+
+    def _refuse(self, reason: str) -> None:
+        self._shed += 1
+        SHED.inc((self.name, reason))
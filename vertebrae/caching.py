@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import json
+from functools import wraps
+
+from aiohttp import hdrs, web
+from multidict import CIMultiDict
+
+from vertebrae.service import Service
+from vertebrae.stores.local import LocalCache, MISSING
+
+# Never replayed to other callers, or recomputed for every response
+UNCACHED_HEADERS = {h.lower() for h in (hdrs.SET_COOKIE, hdrs.CONTENT_LENGTH, hdrs.CONTENT_TYPE, hdrs.ETAG,
+                                        hdrs.DATE, hdrs.TRANSFER_ENCODING)}
+
+
+class Cached:
+    """ Serve repeated GET responses of a route from memory or Redis, with ETag revalidation
+
+    Responses are keyed on method, path, the chosen request params and the chosen headers. Cached
+    responses are served before the handler, and so before any authentication it runs: list the
+    authentication headers (such as a token) in headers, so a cached response is only served to
+    callers that sent the same credentials. A route without any must say so with public=True.
+    Only 200 responses are stored, with every header but Set-Cookie.
+    """
+
+    def __init__(self, ttl=60, params=(), headers=(), store='memory', size=1024, public=False):
+        if not headers and not public:
+            raise ValueError('Cached routes skip the handler\'s authentication: list the headers that identify '
+                             'the caller, or pass public=True if every caller may see the same response')
+        self.ttl = ttl
+        self.params = sorted(params)
+        self.headers = sorted(headers)
+        self.store = store
+        self._local = LocalCache(size=size, ttl=ttl)
+
+    def wrap(self, handle):
+        """ Answer from the cache before the route handler runs """
+        @wraps(handle)
+        async def helper(request: web.Request):
+            if request.method not in ('GET', 'HEAD'):
+                return await handle(request)
+            key = self._key(request)
+            entry = await self._lookup(key)
+            if entry is None:
+                response = await handle(request)
+                if type(response) is not web.Response or response.status != 200 or response.body is None:
+                    return response
+                body = bytes(response.body)
+                entry = dict(body=body, content_type=response.content_type, charset=response.charset,
+                             etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+                             headers=[(k, v) for k, v in response.headers.items()
+                                      if k.lower() not in UNCACHED_HEADERS])
+                await self._save(key, entry)
+                if entry['etag'] not in request.headers.get('If-None-Match', ''):
+                    response.headers[hdrs.ETAG] = entry['etag']
+                    return response
+            return self._respond(request, entry)
+        return helper
+
+    def _key(self, request: web.Request) -> str:
+        data = dict(request.match_info) | dict(request.rel_url.query)
+        parts = [request.method, request.path]
+        parts += [f'{p}={data.get(p)}' for p in self.params]
+        parts += [f'{h}={request.headers.get(h)}' for h in self.headers]
+        return f'vertebrae:route:{hashlib.sha256(chr(0).join(parts).encode()).hexdigest()}'
+
+    async def _lookup(self, key: str):
+        if self.store != 'redis':
+            entry = self._local.get(key)
+            return None if entry is MISSING else entry
+        cached = await Service.db('cache').get(key)
+        if cached:
+            entry = json.loads(cached)
+            entry['body'] = base64.b64decode(entry['body'])
+            return entry
+
+    async def _save(self, key: str, entry: dict) -> None:
+        if self.store != 'redis':
+            return self._local.set(key, entry)
+        await Service.db('cache').set(key, json.dumps(entry | dict(body=base64.b64encode(entry['body']).decode())),
+                                      ex=self.ttl)
+
+    @staticmethod
+    def _respond(request: web.Request, entry: dict) -> web.Response:
+        headers = CIMultiDict(entry.get('headers', ()))
+        headers[hdrs.ETAG] = entry['etag']
+        if entry['etag'] in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=entry['body'], content_type=entry['content_type'], charset=entry['charset'],
+                            headers=headers)
@@ -1,4 +1,5 @@
 import boto3
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ProfileNotFound
 
 from vertebrae.config import Config
@@ -7,11 +8,12 @@ from vertebrae.config import Config
 class AWS:
 
     @classmethod
-    def client(cls, service: str):
+    def client(cls, service: str, **options):
         aws = Config.find('aws')
         if aws:
             session = boto3.session.Session(profile_name=cls.load_profile(aws.get('profile')))
-            return session.client(service_name=service, region_name=Config.find('aws')['region'])
+            return session.client(service_name=service, region_name=Config.find('aws')['region'],
+                                  config=BotoConfig(**options) if options else None)
 
     @classmethod
     def resource(cls, service: str):
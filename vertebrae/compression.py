@@ -0,0 +1,133 @@
+""" Compress responses on the fly, and serve static files from precompressed siblings
+
+    python -m vertebrae.compression client/static
+"""
+import argparse
+import gzip
+import os
+from pathlib import Path
+
+from aiohttp import web
+
+from vertebrae.executors import Executors
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+EXTENSIONS = ('.html', '.css', '.js', '.mjs', '.json', '.map', '.svg', '.txt', '.xml', '.wasm')
+
+
+def _accepted(header: str) -> set:
+    """ The content codings a client accepts, leaving out any refused with q=0 """
+    accepted = set()
+    for coding in header.lower().split(','):
+        name, _, params = coding.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip())
+    return accepted
+
+
+def middleware(threshold=1024, types=TYPES, level=6, quality=4, offload=64 * 1024):
+    """ Compress response bodies of an allowed content type and at least `threshold` bytes with brotli or gzip
+
+    Bodies of `offload` bytes or more are compressed on the shared thread pool, off the event loop.
+    """
+    types = tuple(types)
+
+    @web.middleware
+    async def compress(request: web.Request, handler):
+        response = await handler(request)
+        if type(response) is not web.Response:
+            return response
+        accepted = _accepted(request.headers.get('Accept-Encoding', ''))
+        if brotli and 'br' in accepted:
+            encoding, func = 'br', lambda data: brotli.compress(data, quality=quality)
+        elif 'gzip' in accepted:
+            encoding, func = 'gzip', lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+        else:
+            return response
+        if response.status == 304:
+            # Revalidates a compressed copy, so it must carry the same validators as that copy did
+            _varied(response)
+            return response
+        body = response.body
+        if (not isinstance(body, (bytes, bytearray)) or len(body) < threshold or response.status == 204
+                or 'Content-Encoding' in response.headers or not response.content_type.startswith(types)):
+            return response
+        response.body = await Executors.run('thread', func, body) if len(body) >= offload else func(body)
+        response.headers['Content-Encoding'] = encoding
+        _varied(response)
+        return response
+    return compress
+
+
+def _varied(response: web.Response) -> None:
+    """ Mark a response as depending on Accept-Encoding, with a weak ETag shared by every encoding """
+    response.headers.add('Vary', 'Accept-Encoding')
+    if response.etag and not response.etag.is_weak:
+        response.headers['ETag'] = f'W/"{response.etag.value}"'
+
+
+class StaticFiles:
+    """ Serve files under a directory, from a .br or .gz sibling when the client accepts one """
+
+    def __init__(self, path: str, precompressed=True, max_age=None):
+        self.root = Path(path).resolve()
+        self.precompressed = precompressed
+        self.max_age = max_age
+
+    async def handle(self, request: web.Request) -> web.FileResponse:
+        filepath = (self.root / request.match_info['filename']).resolve()
+        if self.root not in filepath.parents or not filepath.is_file():
+            raise web.HTTPNotFound()
+        headers = dict()
+        if self.max_age is not None:
+            headers['Cache-Control'] = f'public, max-age={self.max_age}'
+        if self.precompressed:
+            headers['Vary'] = 'Accept-Encoding'
+            filepath = self._sibling(filepath, _accepted(request.headers.get('Accept-Encoding', '')))
+        # FileResponse takes the content type and encoding of a .br or .gz file from the name it extends
+        return web.FileResponse(filepath, headers=headers)
+
+    @staticmethod
+    def _sibling(filepath: Path, accepted: set) -> Path:
+        """ Pick the smallest precompressed copy the client accepts, ignoring copies older than the file """
+        modified = filepath.stat().st_mtime
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            sibling = filepath.with_name(filepath.name + suffix)
+            if encoding in accepted and sibling.is_file() and sibling.stat().st_mtime >= modified:
+                return sibling
+        return filepath
+
+
+def precompress(path: str, extensions=EXTENSIONS, min_size=256) -> int:
+    """ Write .gz, and .br when brotli is installed, next to every compressible file; return files written """
+    written = 0
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            source = Path(directory, filename)
+            if source.suffix not in extensions or source.stat().st_size < min_size:
+                continue
+            data = None
+            for suffix, func in (('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0)),
+                                 ('.br', lambda d: brotli.compress(d, quality=11) if brotli else None)):
+                target = source.with_name(source.name + suffix)
+                if target.is_file() and target.stat().st_mtime >= source.stat().st_mtime:
+                    continue
+                data = source.read_bytes() if data is None else data
+                compressed = func(data)
+                if compressed is not None and len(compressed) < len(data):
+                    target.write_bytes(compressed)
+                    written += 1
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompress static files for StaticRoute(precompressed=True)')
+    parser.add_argument('path')
+    parser.add_argument('--min-size', type=int, default=256)
+    args = parser.parse_args()
+    print(f'Wrote {precompress(args.path, min_size=args.min_size)} compressed files')
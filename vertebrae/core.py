@@ -1,80 +1,274 @@
 import asyncio
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
+import signal
+import time
 from collections import namedtuple
-from json import JSONDecodeError
+from functools import wraps
 from logging.handlers import WatchedFileHandler
 
-import aiohttp_cors
-import aiohttp_jinja2
-import jinja2
-from aiohttp import web
+from aiohttp import web, web_log
+from aiohttp.log import access_logger
 
+from vertebrae import serializer
+from vertebrae.admission import Limiter
+from vertebrae.compression import StaticFiles, middleware as compression_middleware
+from vertebrae.config import Config
+from vertebrae.logs import DebugFilter, JsonFormatter, QueueLogging
+from vertebrae.mesh import Mesh
+from vertebrae.metrics import Metrics, middleware as metrics_middleware
 from vertebrae.service import Service
-from detect_probe.service import ProbeService
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-Route = namedtuple('Route', 'method route handle')
-StaticRoute = namedtuple('StaticRoute', 'prefix path')
+
+Route = namedtuple('Route', 'method route handle cache access_log stream limit', defaults=(None, True, False, None))
+StaticRoute = namedtuple('StaticRoute', 'prefix path precompressed max_age', defaults=(False, None))
+Part = namedtuple('Part', 'name filename headers body')
+
+CHUNK_SIZE = 64 * 1024
 
 
 async def strip_request(request: web.Request):
     """ Strip data off request consistently regardless of method """
+    if request.get('vertebrae.stream'):
+        data = {**request.match_info, **request.rel_url.query}
+        if request.content_type.startswith('multipart/'):
+            data['parts'] = _parts(request)
+        else:
+            data['body'] = request.content.iter_chunked(CHUNK_SIZE)
+        return data
     if request.content_type in ['application/x-www-form-urlencoded', 'text/plain']:
         return await request.text()
     else:
-        data = dict(request.match_info) | dict(request.rel_url.query)
+        data = {**request.match_info, **request.rel_url.query}
         if request.content_type == 'application/json':
             try:
-                data.update(dict(await request.json()))
-            except JSONDecodeError:
+                data.update(serializer.loads(await request.read()))
+            except ValueError:
                 pass
         return data
 
 
+def json_response(data, status=200, headers=None) -> web.Response:
+    """ Serialize a response body with the fastest available JSON library """
+    return web.Response(body=serializer.dumps(data), status=status, headers=headers,
+                        content_type='application/json', charset='utf-8')
+
+
+async def stream_response(request: web.Request, chunks, content_type='application/octet-stream', status=200,
+                          headers=None) -> web.StreamResponse:
+    """ Send a sync or async iterable of bytes with chunked transfer encoding, as each chunk is produced """
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = content_type
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            await response.write(chunk)
+    else:
+        for chunk in chunks:
+            await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def ndjson_response(request: web.Request, items, status=200, headers=None) -> web.StreamResponse:
+    """ Stream a sync or async iterable as newline-delimited JSON, one line per item """
+    async def lines():
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                yield serializer.dumps(item) + b'\n'
+        else:
+            for item in items:
+                yield serializer.dumps(item) + b'\n'
+    return await stream_response(request, lines(), content_type='application/x-ndjson', status=status,
+                                 headers=headers)
+
+
+async def render_stream(request: web.Request, template: str, context: dict, status=200, headers=None,
+                        buffer_size=16 * 1024) -> web.StreamResponse:
+    """ Stream a Jinja template to the client as it renders, asynchronously when the environment allows it """
+    import aiohttp_jinja2
+    env = request.config_dict[aiohttp_jinja2.APP_KEY]
+    context = {**request.get(aiohttp_jinja2.REQUEST_CONTEXT_KEY, {}), **context}
+    compiled = env.get_template(template)
+
+    async def chunks():
+        buffer = []
+        size = 0
+        pieces = compiled.generate_async(context) if env.is_async else _iterate(compiled.generate(context))
+        async for piece in pieces:
+            buffer.append(piece)
+            size += len(piece)
+            if size >= buffer_size:
+                yield ''.join(buffer).encode('utf-8')
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer).encode('utf-8')
+    return await stream_response(request, chunks(), content_type='text/html; charset=utf-8', status=status,
+                                 headers=headers)
+
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+
+async def _parts(request: web.Request):
+    """ Yield each part of a multipart body in order; read a part's body before moving to the next """
+    reader = await request.multipart()
+    while (part := await reader.next()) is not None:
+        yield Part(name=part.name, filename=part.filename, headers=part.headers, body=_part_chunks(part))
+
+
+async def _part_chunks(part):
+    while chunk := await part.read_chunk(CHUNK_SIZE):
+        yield chunk
+
+
+def _streamed(handle):
+    """ Mark requests to a route so strip_request hands over the body unread """
+    @wraps(handle)
+    async def helper(request: web.Request):
+        request['vertebrae.stream'] = True
+        return await handle(request)
+    return helper
+
+
 def create_log(name: str) -> logging.Logger:
     """ Create a logging object for general use """
     return logging.getLogger(f'vertebrae.{name}')
 
 
+class AccessLogger(web_log.AccessLogger):
+    """ Skip access log lines for quiet routes, and formatting entirely when the log level hides them """
+
+    def log(self, request: web.BaseRequest, response: web.StreamResponse, time: float) -> None:
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        if request.match_info.route in request.app.get('quiet_routes', ()):
+            return
+        super().log(request, response, time)
+
+
 class Server:
     """ A server is the driver that runs applications """
 
-    def __init__(self, services, applications):
+    def __init__(self, services, applications, loop_policy=None):
         self.setup_logger(path=os.getenv('logfile'))
+        self.applications = applications
+        if loop_policy or uvloop:
+            asyncio.set_event_loop_policy(loop_policy or uvloop.EventLoopPolicy())
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
         for app in applications:
             app.attach_routes()
             app.attach_gui()
-            self.loop.run_until_complete(app.start())
         for service in services:
             Service.enroll(service.log.name, service)
         create_log('server').info(f'Serving {len(applications)} apps with {len(services)} services')
 
-    def run(self):
+    def run(self, workers=1):
+        """ Serve from this process, or from `workers` forked processes sharing each port """
         try:
             self.start_probe()
-            self.loop.run_until_complete(Service.initialize())
-            self.loop.run_forever()
+            if workers > 1:
+                self.supervise(workers=workers)
+            else:
+                self.serve()
         except KeyboardInterrupt:
             logging.info('Keyboard interrupt received')
 
+    def serve(self, reuse_port=False):
+        """ Run applications and services on this process until SIGTERM, then drain them """
+        self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+        for app in self.applications:
+            self.loop.run_until_complete(app.start(reuse_port=reuse_port))
+        self.loop.run_until_complete(Service.initialize())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.shutdown())
+
+    async def shutdown(self):
+        """ Stop accepting connections, finish in-flight requests and close database connections """
+        for app in self.applications:
+            await app.stop()
+        await Service.shutdown()
+
+    def supervise(self, workers: int):
+        """ Fork workers that share each port and replace any that exit, until SIGTERM """
+        log = create_log('server')
+        context = multiprocessing.get_context('fork')
+        processes = dict()
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while not stopping:
+            for index in range(workers):
+                process = processes.get(index)
+                if process and process.is_alive():
+                    continue
+                if process:
+                    log.warning(f'Worker {process.pid} exited with code {process.exitcode}, restarting')
+                    time.sleep(1)
+                processes[index] = context.Process(target=self.worker, name=f'vertebrae-worker-{index}')
+                processes[index].start()
+            multiprocessing.connection.wait([p.sentinel for p in processes.values()], timeout=1)
+        log.info(f'Draining {workers} workers')
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+    def worker(self):
+        """ Serve from a forked process, on a fresh event loop with its own database connections """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.setup_logger(path=os.getenv('logfile'))
+        self.loop.close()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.serve(reuse_port=True)
+        finally:
+            QueueLogging.stop()
+
     @staticmethod
     def start_probe():
-        """ Detach a Detect Probe inside the application process """
+        """ Detach a Detect Probe inside the application process, when an account is configured """
+        if not os.getenv('PRELUDE_ACCOUNT_ID'):
+            return
+        from detect_probe.service import ProbeService
         service = ProbeService(account_id=os.getenv('PRELUDE_ACCOUNT_ID'), secret=os.getenv('PRELUDE_ACCOUNT_SECRET'))
         service.start(token=service.register())
 
     @staticmethod
     def setup_logger(path):
-        logging.basicConfig(
-            level='DEBUG',
-            format='%(asctime)s - %(levelname)-5s [%(name)s] %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S',
-            handlers=[WatchedFileHandler(filename=path)] if path else None
-        )
+        settings = Config.find('logging') or {}
+        handler = WatchedFileHandler(filename=path) if path else logging.StreamHandler()
+        if settings.get('json'):
+            handler.setFormatter(JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S'))
+        else:
+            handler.setFormatter(logging.Formatter(fmt='%(asctime)s - %(levelname)-5s [%(name)s] %(message)s',
+                                                   datefmt='%Y-%m-%d %H:%M:%S'))
+        if settings.get('queue'):
+            handler = QueueLogging.start(handler)
+        if settings.get('debug_rate') or settings.get('debug_sample', 1.0) < 1.0:
+            handler.addFilter(DebugFilter(rate=settings.get('debug_rate'), sample=settings.get('debug_sample', 1.0)))
+        logging.basicConfig(level=settings.get('level', 'DEBUG'), handlers=[handler], force=True)
         for logger_name in logging.root.manager.loggerDict.keys():
             if not logger_name.startswith('vertebrae'):
                 logging.getLogger(logger_name).setLevel(logging.ERROR)
@@ -83,35 +277,108 @@ class Server:
 class Application:
     """ An application is a API """
 
-    def __init__(self, port, routes, client_max_size=4096, template_directory='templates'):
+    def __init__(self, port, routes, client_max_size=4096, template_directory='templates', backlog=128,
+                 keepalive_timeout=75.0, access_log=True, access_log_format=web_log.AccessLogger.LOG_FORMAT,
+                 metrics=False, mesh=False, cors=True, admission=None, templates=None, compression=None):
         self.port = port
         self.routes = routes
         self.template_directory = template_directory
+        self.templates = templates or Config.find('templates') or {}
+        self.backlog = backlog
+        self.keepalive_timeout = keepalive_timeout
+        self.access_log = access_log
+        self.access_log_format = access_log_format
+        self.runner = None
+        admission = admission or Config.find('admission')
+        self.limiter = Limiter(name=f'app:{port}', **admission) if admission else None
         self.application = web.Application(client_max_size=client_max_size)
-        self.application.router.add_route('GET', '/ping', self.pong)
-        self.cors = aiohttp_cors.setup(self.application, defaults={
-            "*": aiohttp_cors.ResourceOptions(
-                    expose_headers="*",
-                    allow_headers="*",
-                )
-        })
+        self.application['quiet_routes'] = {self.application.router.add_route('GET', '/ping', self.pong)}
+        if metrics:
+            self.application.middlewares.append(metrics_middleware)
+            self.application['quiet_routes'].add(self.application.router.add_route('GET', '/metrics', Metrics.handle))
+        if mesh:
+            self.application.router.add_route('POST', '/mesh', self.mesh)
+        compression = compression or Config.find('compression')
+        if compression:
+            self.application.middlewares.append(
+                compression_middleware(**(compression if isinstance(compression, dict) else {})))
+        self.cors = None
+        if cors:
+            import aiohttp_cors
+            self.cors = aiohttp_cors.setup(self.application, defaults={
+                "*": aiohttp_cors.ResourceOptions(
+                        expose_headers="*",
+                        allow_headers="*",
+                    )
+            })
 
     def attach_routes(self):
         for collection in self.routes:
             for route in collection.routes():
                 route_type = type(route)
                 if route_type == Route:
-                    self.cors.add(self.application.router.add_route(route.method, route.route, route.handle))
+                    handle = route.handle
+                    if route.limit:
+                        if route.limit.name is None:
+                            route.limit.name = f'{route.method} {route.route}'
+                        handle = route.limit.wrap(handle)
+                    if self.limiter:
+                        handle = self.limiter.wrap(handle)
+                    if route.cache:
+                        handle = route.cache.wrap(handle)
+                    if route.stream:
+                        handle = _streamed(handle)
+                    resource_route = self.application.router.add_route(route.method, route.route, handle)
+                    if not route.access_log:
+                        self.application['quiet_routes'].add(resource_route)
+                    if self.cors:
+                        self.cors.add(resource_route)
                 elif route_type == StaticRoute:
-                    self.application.router.add_static(route.prefix, route.path)
+                    if route.precompressed or route.max_age is not None:
+                        files = StaticFiles(route.path, precompressed=route.precompressed, max_age=route.max_age)
+                        self.application.router.add_get(f'{route.prefix.rstrip("/")}/{{filename:.+}}', files.handle)
+                    else:
+                        self.application.router.add_static(route.prefix, route.path)
 
     def attach_gui(self):
-        aiohttp_jinja2.setup(self.application, loader=jinja2.FileSystemLoader(f'client/{self.template_directory}'))
+        """ Render templates with Jinja, if this application has any """
+        templates = f'client/{self.template_directory}'
+        if not os.path.isdir(templates):
+            return
+        import aiohttp_jinja2
+        import jinja2
+        bytecode_cache = self.templates.get('bytecode_cache')
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+        precompile = self.templates.get('precompile', False)
+        enable_async = self.templates.get('enable_async', False)
+        # Bytecode compiled for async rendering differs, but Jinja keys its cache on the template source only
+        pattern = '__jinja2_async_%s.cache' if enable_async else '__jinja2_%s.cache'
+        env = aiohttp_jinja2.setup(
+            self.application, loader=jinja2.FileSystemLoader(templates),
+            auto_reload=self.templates.get('auto_reload', True),
+            enable_async=enable_async,
+            bytecode_cache=jinja2.FileSystemBytecodeCache(bytecode_cache, pattern) if bytecode_cache else None,
+            cache_size=-1 if precompile else 400
+        )
+        if precompile:
+            for name in env.list_templates():
+                env.get_template(name)
+            create_log('server').debug(f'Compiled {len(env.list_templates())} templates')
 
-    async def start(self):
-        runner = web.AppRunner(self.application)
-        await runner.setup()
-        await web.TCPSite(runner=runner, port=self.port).start()
+    async def start(self, reuse_port=False):
+        self.runner = web.AppRunner(self.application, keepalive_timeout=self.keepalive_timeout,
+                                    access_log=access_logger if self.access_log else None,
+                                    access_log_class=AccessLogger, access_log_format=self.access_log_format)
+        await self.runner.setup()
+        await web.TCPSite(runner=self.runner, port=self.port, backlog=self.backlog, reuse_port=reuse_port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
 
     async def pong(self, req: web.Request) -> web.Response:
         return web.Response(status=200)
+
+    async def mesh(self, req: web.Request) -> web.Response:
+        return await Mesh.serve(req, Service.find, Service)
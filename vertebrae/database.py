@@ -1,24 +1,107 @@
+import asyncio
+import importlib
+import inspect
 import logging
+import time
+from functools import wraps
 
-from vertebrae.stores.cache import Cache
-from vertebrae.stores.directory import Directory
-from vertebrae.stores.relational import Relational
-from vertebrae.stores.s3 import S3
+from vertebrae.metrics import Gauge, Metrics
+
+
+class Connecting:
+    """ A store first requested after startup: its async methods wait until it has connected, and its sync
+    methods refuse to run before then """
+
+    def __init__(self, store: str, handler, connected: asyncio.Future):
+        self._store = store
+        self._handler = handler
+        self._connected = connected
+
+    def __getattr__(self, name):
+        attr = getattr(self._handler, name)
+        connected = self._connected
+        if connected.done() and not connected.cancelled() and connected.exception() is None:
+            return attr
+        if inspect.isasyncgenfunction(attr):
+            @wraps(attr)
+            async def generator(*args, **kwargs):
+                await asyncio.shield(connected)
+                async for item in attr(*args, **kwargs):
+                    yield item
+            return generator
+        if inspect.iscoroutinefunction(attr):
+            @wraps(attr)
+            async def helper(*args, **kwargs):
+                await asyncio.shield(connected)
+                return await attr(*args, **kwargs)
+            return helper
+        if callable(attr):
+            @wraps(attr)
+            def refuse(*args, **kwargs):
+                if not connected.done() or connected.cancelled() or connected.exception() is not None:
+                    raise RuntimeError(f'The {self._store} store is still connecting; await one of its async '
+                                       f'methods before calling {name}')
+                return attr(*args, **kwargs)
+            return refuse
+        return attr
 
 
 class Database:
-    """ Handlers to all data stores used by this application """
+    """ Handlers to all data stores used by this application, created on first use """
+
+    stores = dict(relational='vertebrae.stores.relational:Relational', cache='vertebrae.stores.cache:Cache',
+                  directory='vertebrae.stores.directory:Directory', s3='vertebrae.stores.s3:S3')
 
     def __init__(self):
-        log = logging.getLogger(f'vertebrae.database')
-        self.cache = Cache(log=log)
-        self.directory = Directory(log=log)
-        self.relational = Relational(log=log)
-        self.s3 = S3(log=log)
+        self.log = logging.getLogger('vertebrae.database')
+        self.timings = dict()
+        self._handlers = dict()
+        self._connected = False
+        self._connecting = dict()
+        Metrics.register(Gauge('vertebrae_store_connect_seconds', 'Time taken to connect each store', ('store',),
+                               collect=lambda: {(name,): seconds for name, seconds in self.timings.items()}))
+
+    def __getattr__(self, store):
+        if store not in self.stores:
+            raise AttributeError(store)
+        return self.get(store)
+
+    def get(self, store: str):
+        """ Return a store handler; one created after startup connects in the background and is awaited on use """
+        handler = self._handlers.get(store)
+        if handler is None:
+            module, name = self.stores[store].split(':')
+            handler = self._handlers[store] = getattr(importlib.import_module(module), name)(log=self.log)
+            if self._connected:
+                task = self._connecting[store] = asyncio.ensure_future(self._connect(store, handler))
+                task.add_done_callback(lambda _: self._connected_in_background(store, task))
+        task = self._connecting.get(store)
+        return Connecting(store, handler, task) if task else handler
+
+    def _connected_in_background(self, store: str, task: asyncio.Task) -> None:
+        """ Forget a store that failed to connect, so the next request for it tries again """
+        self._connecting.pop(store, None)
+        if task.cancelled() or task.exception():
+            self._handlers.pop(store, None)
 
     async def connect(self) -> None:
-        """ Establish connections to applicable databases """
-        await self.relational.connect()
-        await self.cache.connect()
-        await self.directory.connect()
-        await self.s3.connect()
+        """ Establish connections to every store in use, concurrently """
+        self._connected = True
+        await asyncio.gather(*(self._connect(name, handler) for name, handler in list(self._handlers.items())))
+
+    async def _connect(self, name: str, handler) -> None:
+        start = time.monotonic()
+        try:
+            await handler.connect()
+        except Exception as e:
+            self.log.error(f'Failed to connect {name}: {e}')
+            raise
+        self.timings[name] = time.monotonic() - start
+        self.log.info(f'Connected {name} in {self.timings[name]:.3f}s')
+
+    async def close(self) -> None:
+        """ Flush pending writes and release connections """
+        for handler in self._handlers.values():
+            close = getattr(handler, 'close', None)
+            if close:
+                await close()
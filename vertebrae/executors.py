@@ -0,0 +1,88 @@
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import time
+
+from vertebrae.config import Config
+from vertebrae.metrics import Gauge, Histogram, Metrics
+
+DURATION = Metrics.register(Histogram('vertebrae_executor_seconds', 'Time from submitting work to its result',
+                                      ('pool',)))
+
+
+class Executors:
+    """ A process pool for CPU-bound work and a thread pool for blocking I/O, shared by every service
+
+    Pools are created on first use in each process, so forked server workers never inherit one.
+    """
+
+    _pools = dict()
+    _stats = dict(process=dict(pending=0, completed=0, failed=0), thread=dict(pending=0, completed=0, failed=0))
+
+    @classmethod
+    async def run(cls, pool: str, func, *args, **kwargs):
+        """ Run a function on the 'process' or 'thread' pool and wait for its result """
+        executor = cls._executor(pool)
+        stats = cls._stats[pool]
+        stats['pending'] += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(executor,
+                                                                       functools.partial(func, *args, **kwargs))
+        except Exception:
+            stats['failed'] += 1
+            raise
+        finally:
+            stats['pending'] -= 1
+            DURATION.observe((pool,), time.perf_counter() - start)
+        stats['completed'] += 1
+        return result
+
+    @classmethod
+    def stats(cls) -> dict:
+        """ Report workers, pending and queued work, and outcomes for each pool """
+        report = dict()
+        for pool, stats in cls._stats.items():
+            workers = cls._workers(pool)
+            report[pool] = dict(workers=workers, queued=max(0, stats['pending'] - workers), **stats)
+        return report
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        """ Drop queued work and wait, off the event loop, for running work to finish """
+        pools, cls._pools = cls._pools, dict()
+        for executor in pools.values():
+            await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(executor.shutdown, wait=True, cancel_futures=True))
+
+    @classmethod
+    def _executor(cls, pool: str) -> concurrent.futures.Executor:
+        executor = cls._pools.get(pool)
+        if executor is None:
+            if pool == 'process':
+                context = multiprocessing.get_context(cls._settings().get('start_method', 'forkserver'))
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=cls._workers(pool),
+                                                                  mp_context=context)
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=cls._workers(pool),
+                                                                 thread_name_prefix='vertebrae-io')
+            cls._pools[pool] = executor
+        return executor
+
+    @classmethod
+    def _workers(cls, pool: str) -> int:
+        if pool == 'process':
+            return cls._settings().get('processes') or os.cpu_count() or 1
+        return cls._settings().get('threads') or min(32, (os.cpu_count() or 1) + 4)
+
+    @staticmethod
+    def _settings() -> dict:
+        return Config.find('executors') or {}
+
+
+Metrics.register(Gauge('vertebrae_executor_pending', 'Work submitted to a pool and not yet finished', ('pool',),
+                       collect=lambda: {(pool,): stats['pending'] for pool, stats in Executors.stats().items()}))
+Metrics.register(Gauge('vertebrae_executor_queued', 'Work waiting for a free pool worker', ('pool',),
+                       collect=lambda: {(pool,): stats['queued'] for pool, stats in Executors.stats().items()}))
@@ -0,0 +1,78 @@
+import atexit
+import copy
+import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from vertebrae import serializer
+
+
+class JsonFormatter(logging.Formatter):
+    """ Format each record as a single line of JSON """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = dict(time=self.formatTime(record, self.datefmt), level=record.levelname, logger=record.name,
+                     message=record.getMessage())
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return serializer.dumps(entry).decode('utf-8')
+
+
+class DebugFilter(logging.Filter):
+    """ Sample debug records and cap how many each logger writes per second """
+
+    def __init__(self, rate=None, sample=1.0):
+        super().__init__()
+        self.rate = rate
+        self.sample = sample
+        self._windows = dict()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return False
+        if self.rate is None:
+            return True
+        second = int(time.monotonic())
+        window, count = self._windows.get(record.name, (second, 0))
+        if window != second:
+            window, count = second, 0
+        self._windows[record.name] = (window, count + 1)
+        return count < self.rate
+
+
+class _QueueHandler(QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """ Merge message arguments on the calling thread and leave formatting to the writer thread """
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+class QueueLogging:
+    """ Hand log records to a writer thread, so handlers never block the event loop """
+
+    _listener = None
+
+    @classmethod
+    def start(cls, handler: logging.Handler) -> QueueHandler:
+        """ Write records through `handler` on a background thread and return the handler that feeds it """
+        cls.stop()
+        records = queue.SimpleQueue()
+        cls._listener = QueueListener(records, handler, respect_handler_level=True)
+        cls._listener.start()
+        return _QueueHandler(records)
+
+    @classmethod
+    def stop(cls) -> None:
+        """ Write out queued records and stop the writer thread """
+        if cls._listener:
+            listener, cls._listener = cls._listener, None
+            listener.stop()
+
+
+atexit.register(QueueLogging.stop)
@@ -0,0 +1,151 @@
+import asyncio
+import hmac
+import inspect
+import logging
+
+import aiohttp
+from aiohttp import web
+
+from vertebrae import serializer
+from vertebrae.config import Config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = 'application/msgpack'
+JSON = 'application/json'
+
+
+def pack(obj, content_type=None) -> (bytes, str):
+    """ Encode as `content_type`, or with msgpack when installed and JSON otherwise """
+    if content_type == MSGPACK or (content_type is None and msgpack):
+        return msgpack.packb(obj, use_bin_type=True), MSGPACK
+    return serializer.dumps(obj), JSON
+
+
+def unpack(data: bytes, content_type: str):
+    if content_type == MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    return serializer.loads(data)
+
+
+class Mesh:
+    """ Calls to services hosted by other processes, batched per peer over pooled keep-alive connections """
+
+    def __init__(self):
+        self.log = logging.getLogger('vertebrae.mesh')
+        self._session = None
+        self._pending = dict()
+        self._sends = set()
+
+    @staticmethod
+    def settings() -> dict:
+        return Config.find('mesh') or {}
+
+    @classmethod
+    def peer(cls, name: str):
+        """ Find the base URL of the process hosting a service """
+        return cls.settings().get('services', {}).get(name)
+
+    async def call(self, url: str, name: str, method: str, args=(), kwargs=None, timeout=None):
+        """ Queue a call for the peer, sent along with every other call made to it in this loop tick """
+        batch = self._pending.get(url)
+        if batch is None:
+            batch = self._pending[url] = []
+            task = asyncio.create_task(self._send(url))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+        future = asyncio.get_running_loop().create_future()
+        batch.append((dict(service=name, method=method, args=list(args), kwargs=kwargs or {}), future))
+        return await asyncio.wait_for(future, timeout)
+
+    async def close(self) -> None:
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _client(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            settings = self.settings()
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                limit=settings.get('connections', 100), keepalive_timeout=settings.get('keepalive_timeout', 30)))
+        return self._session
+
+    async def _send(self, url: str) -> None:
+        batch = [(call, future) for call, future in self._pending.pop(url) if not future.done()]
+        if not batch:
+            return
+        body, content_type = pack([call for call, _ in batch])
+        headers = {'Content-Type': content_type, 'Authorization': f'Bearer {self.settings().get("token")}'}
+        try:
+            async with self._client().post(f'{url}/mesh', data=body, headers=headers) as response:
+                if response.status != 200:
+                    raise ConnectionError(f'Mesh peer {url} answered {response.status}')
+                results = unpack(await response.read(), response.content_type)
+        except Exception as e:
+            self.log.error(f'Failed mesh call to {url}: {e}')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e if isinstance(e, ConnectionError) else ConnectionError(str(e)))
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if 'error' in result:
+                future.set_exception(RuntimeError(result['error']))
+            else:
+                future.set_result(result.get('result'))
+
+    @staticmethod
+    def exported(service, method: str, base: type):
+        """ Find a public coroutine method defined by the service itself, never a lifecycle method from `base` """
+        if service is None or method.startswith('_') or method == 'start' or hasattr(base, method):
+            return None
+        for klass in type(service).__mro__:
+            if method in vars(klass):
+                if issubclass(base, klass):
+                    return None
+                func = getattr(service, method)
+                return func if inspect.iscoroutinefunction(func) else None
+
+    @staticmethod
+    def _valid(calls) -> bool:
+        """ Check a batch is a list of calls, each naming a service and method with its arguments """
+        return isinstance(calls, list) and all(
+            isinstance(call, dict) and isinstance(call.get('service'), str) and isinstance(call.get('method'), str)
+            and isinstance(call.get('args'), list) and isinstance(call.get('kwargs'), dict)
+            and all(isinstance(k, str) for k in call['kwargs'])
+            for call in calls)
+
+    @classmethod
+    async def serve(cls, request: web.Request, find, base: type) -> web.Response:
+        """ Run a batch of calls against local services, found through `find` and defined below `base` """
+        settings = cls.settings()
+        token = settings.get('token')
+        if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return web.Response(status=403)
+        if request.content_type == MSGPACK and not msgpack:
+            return web.Response(status=415)
+        size = request.content_length
+        if size is None or size > settings.get('max_size', 4 * 1024 * 1024):
+            return web.Response(status=413)
+        try:
+            calls = unpack(await request.content.readexactly(size), request.content_type)
+        except ValueError:
+            return web.Response(status=400)
+        if not cls._valid(calls):
+            return web.Response(status=400)
+
+        async def _run(call):
+            func = cls.exported(find(call['service']), call['method'], base)
+            if func is None:
+                return dict(error=f'No method {call["method"]} on service {call["service"]}')
+            try:
+                return dict(result=await func(*call['args'], **call['kwargs']))
+            except Exception as e:
+                return dict(error=f'{type(e).__name__}: {e}')
+
+        body, content_type = pack(await asyncio.gather(*(_run(call) for call in calls)), request.content_type)
+        return web.Response(body=body, content_type=content_type)
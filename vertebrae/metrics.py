@@ -0,0 +1,191 @@
+import bisect
+import inspect
+import time
+from functools import wraps
+
+from aiohttp import web
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+class Counter:
+    """ A monotonically increasing count per label set """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = dict()
+
+    def inc(self, labels=(), amount=1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield f'{self.name}{_labels(self.labels, labels)} {value}'
+
+
+class Gauge(Counter):
+    """ A value that goes up and down, or is read from `collect` at scrape time """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def dec(self, labels=(), amount=1) -> None:
+        self.inc(labels, -amount)
+
+    def set(self, labels=(), value=0) -> None:
+        self._values[labels] = value
+
+    def samples(self):
+        if self.collect:
+            self._values = dict(self.collect())
+        yield from super().samples()
+
+
+class Histogram:
+    """ Counts of observed values in cumulative buckets, plus their sum """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = dict()
+
+    def observe(self, labels=(), value=0.0) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {total}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {cumulative}'
+
+
+class Metrics:
+    """ Every metric in this process, rendered in the Prometheus text format """
+
+    _metrics = dict()
+
+    @classmethod
+    def register(cls, metric):
+        """ Add a metric, or return the one already registered under its name """
+        return cls._metrics.setdefault(metric.name, metric)
+
+    @classmethod
+    def expose(cls) -> str:
+        lines = []
+        for metric in cls._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    async def handle(cls, request: web.Request) -> web.Response:
+        return web.Response(text=cls.expose(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+
+REQUESTS = Metrics.register(Counter('vertebrae_requests_total', 'Requests handled',
+                                    ('method', 'route', 'status')))
+REQUEST_LATENCY = Metrics.register(Histogram('vertebrae_request_seconds', 'Request latency',
+                                             ('method', 'route')))
+IN_FLIGHT = Metrics.register(Gauge('vertebrae_requests_in_flight', 'Requests being handled', ('route',)))
+STORE_LATENCY = Metrics.register(Histogram('vertebrae_store_seconds', 'Store operation latency',
+                                           ('store', 'operation')))
+STORE_ERRORS = Metrics.register(Counter('vertebrae_store_errors_total', 'Failed store operations',
+                                        ('store', 'operation')))
+
+
+@web.middleware
+async def middleware(request: web.Request, handler):
+    """ Record request counts, latency and in-flight requests per route template """
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else 'unmatched'
+    status = 500
+    IN_FLIGHT.inc((route,))
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_LATENCY.observe((request.method, route), time.perf_counter() - start)
+        REQUESTS.inc((request.method, route, status))
+        IN_FLIGHT.dec((route,))
+
+
+def record_error(store: str, operation: str) -> None:
+    """ Count a store failure that was handled rather than raised """
+    STORE_ERRORS.inc((store, operation))
+
+
+def timed(store: str):
+    """ Record the latency and raised errors of a store operation """
+    def decorator(func):
+        operation = func.__name__
+
+        if inspect.isasyncgenfunction(func):
+            @wraps(func)
+            async def generator(*args, **kwargs):
+                # Only time spent producing items counts, not the time the caller spends between them
+                iterator = func(*args, **kwargs)
+                spent = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = await iterator.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            spent += time.perf_counter() - start
+                        yield item
+                except Exception:
+                    STORE_ERRORS.inc((store, operation))
+                    raise
+                finally:
+                    start = time.perf_counter()
+                    await iterator.aclose()
+                    STORE_LATENCY.observe((store, operation), spent + time.perf_counter() - start)
+            return generator
+
+        @wraps(func)
+        async def helper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                STORE_ERRORS.inc((store, operation))
+                raise
+            finally:
+                STORE_LATENCY.observe((store, operation), time.perf_counter() - start)
+        return helper
+    return decorator
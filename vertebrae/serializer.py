@@ -0,0 +1,38 @@
+""" JSON encoding through the fastest installed library: orjson, then ujson, then the standard library """
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+if orjson:
+    NAME = 'orjson'
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data):
+        return orjson.loads(data)
+elif ujson:
+    NAME = 'ujson'
+
+    def dumps(obj) -> bytes:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def loads(data):
+        return ujson.loads(data)
+else:
+    NAME = 'json'
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
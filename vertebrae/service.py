@@ -4,6 +4,11 @@ import hashlib
 import logging
 
 from vertebrae.database import Database
+from vertebrae.executors import Executors
+from vertebrae.mesh import Mesh
+from vertebrae.workers import Worker
+
+HASH_OFFLOAD = 1024 * 1024
 
 
 class Service(abc.ABC):
@@ -11,6 +16,9 @@ class Service(abc.ABC):
 
     _services = dict()
     _database = Database()
+    _mesh = Mesh()
+    _tasks = set()
+    _workers = []
 
     def __init__(self, name: str):
         self.log = logging.getLogger(f'vertebrae.{name}')
@@ -25,6 +33,17 @@ class Service(abc.ABC):
         """ Find a service by name """
         return cls._services.get(f'vertebrae.{name}')
 
+    @classmethod
+    async def call(cls, name: str, method: str, *args, timeout=None, **kwargs):
+        """ Call a service method, directly when the service is local and over the mesh when hosted elsewhere """
+        service = cls.find(name)
+        if service:
+            return await asyncio.wait_for(getattr(service, method)(*args, **kwargs), timeout)
+        url = Mesh.peer(name)
+        if not url:
+            raise LookupError(f'No service named {name}')
+        return await cls._mesh.call(url, name, method, args, kwargs, timeout=timeout)
+
     @classmethod
     def db(cls, store=None) -> ():
         """ Return a handler to the DB """
@@ -39,7 +58,51 @@ class Service(abc.ABC):
         for name, service in cls._services.items():
             func = getattr(service, 'start', None)
             if callable(func):
-                asyncio.create_task(func())
+                cls._tasks.add(asyncio.create_task(cls._supervise(service, func)))
+        for worker in cls._workers:
+            await worker.start(cache=cls.db('cache'))
+
+    @classmethod
+    async def _supervise(cls, service, func) -> None:
+        """ Run a service 'start' function, restarting it with backoff whenever it fails """
+        delay = 1
+        while True:
+            try:
+                return await func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                service.log.exception(f'Service start failed, restarting in {delay}s: {e}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    def consume(self, queue: str, handle, **options) -> Worker:
+        """ Register consumers for a Redis list queue, started and drained alongside the services """
+        worker = Worker(queue, handle, **options)
+        Service._workers.append(worker)
+        return worker
+
+    @classmethod
+    async def shutdown(cls, timeout=30) -> None:
+        """ Drain workers, stop 'start' functions and close database and mesh connections """
+        await asyncio.gather(*(worker.stop(timeout=timeout) for worker in cls._workers))
+        for task in cls._tasks:
+            task.cancel()
+        await asyncio.gather(*cls._tasks, return_exceptions=True)
+        cls._tasks.clear()
+        await cls._mesh.close()
+        await cls._database.close()
+        await Executors.shutdown()
+
+    @classmethod
+    async def run_cpu(cls, func, *args, **kwargs):
+        """ Run CPU-bound work on the shared process pool; the function and arguments must be picklable """
+        return await Executors.run('process', func, *args, **kwargs)
+
+    @classmethod
+    async def run_io(cls, func, *args, **kwargs):
+        """ Run blocking I/O on the shared thread pool """
+        return await Executors.run('thread', func, *args, **kwargs)
 
     @classmethod
     def create_log(cls, name: str) -> logging.Logger:
@@ -51,3 +114,25 @@ class Service(abc.ABC):
         """ Hash a string """
         func = getattr(hashlib, algo)
         return func(s.encode('utf-8')).hexdigest()
+
+    @classmethod
+    async def digest(cls, data, algo='sha256') -> str:
+        """ Hash a string, bytes or a sync or async iterable of chunks, hashing large pieces off the event loop """
+        digest = getattr(hashlib, algo)()
+        if isinstance(data, (str, bytes, bytearray, memoryview)):
+            data = [data]
+
+        async def update(chunk):
+            chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            if len(chunk) >= HASH_OFFLOAD:
+                await cls.run_io(digest.update, chunk)
+            else:
+                digest.update(chunk)
+
+        if hasattr(data, '__aiter__'):
+            async for chunk in data:
+                await update(chunk)
+        else:
+            for chunk in data:
+                await update(chunk)
+        return digest.hexdigest()
@@ -1,6 +1,12 @@
+import asyncio
+
 import aioredis
 
 from vertebrae.config import Config
+from vertebrae.metrics import timed
+from vertebrae.stores.local import LocalCache, MISSING
+
+INVALIDATE = 'vertebrae:invalidate'
 
 
 class Cache:
@@ -8,38 +14,194 @@ class Cache:
     def __init__(self, log):
         self.log = log
         self._cache = None
+        self._batch = False
+        self._pending = dict()
+        self._flushes = set()
+        self._local = dict()
+        self._loads = dict()
+        self._generation = 0
+        self._listener = None
 
     async def connect(self) -> None:
         """ Establish a connection to Redis """
         redis = Config.find('redis')
         if redis:
+            self._batch = redis.get('batch', False)
             self._cache = aioredis.from_url(
-                url=f'redis://{redis.get("host")}',
-                port=6379,
+                url=f'redis://{redis.get("host")}:{redis.get("port", 6379)}',
                 db=redis.get("database", 0),
+                max_connections=redis.get('max_connections'),
+                socket_timeout=redis.get('socket_timeout'),
+                socket_connect_timeout=redis.get('socket_connect_timeout'),
                 decode_responses=True
             )
+            self._local = self._tiers(redis.get('local') or [])
+            if self._local:
+                self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+        if self._cache:
+            await self._cache.close()
 
+    def stats(self) -> dict:
+        """ Report hits, misses and evictions of each in-process tier """
+        return {prefix: tier.stats() for prefix, tier in self._local.items()}
+
+    @timed('cache')
     async def get(self, k):
-        return await self._cache.get(k)
+        tier = self._tier(k)
+        if tier is None:
+            return await self._get(k)
+        value = tier.get(k)
+        if value is not MISSING:
+            return value
+        load = self._loads.get(k)
+        if load is None:
+            load = self._loads[k] = asyncio.ensure_future(self._load(tier, k))
+            load.add_done_callback(lambda _: self._loads.pop(k, None))
+        return await asyncio.shield(load)
+
+    async def _load(self, tier: LocalCache, k):
+        """ Fetch a key missing from its tier, unless it is invalidated while in flight """
+        generation = self._generation
+        value = await self._get(k)
+        if generation == self._generation:
+            tier.set(k, value)
+        return value
+
+    async def _get(self, k):
+        if not self._batch:
+            return await self._cache.get(k)
+        future = self._pending.get(k)
+        if future is None:
+            if not self._pending:
+                task = asyncio.create_task(self._flush_gets())
+                self._flushes.add(task)
+                task.add_done_callback(self._flushes.discard)
+            future = self._pending[k] = asyncio.get_running_loop().create_future()
+        return await asyncio.shield(future)
+
+    async def _flush_gets(self) -> None:
+        """ Answer every get queued during this loop tick with a single MGET """
+        pending, self._pending = self._pending, dict()
+        try:
+            values = await self._cache.mget(*pending)
+        except Exception as e:
+            for future in pending.values():
+                future.set_exception(e)
+        else:
+            for future, value in zip(pending.values(), values):
+                future.set_result(value)
+
+    @timed('cache')
+    async def mget(self, *keys):
+        return await self._cache.mget(*keys)
+
+    @timed('cache')
+    async def mset(self, mapping: dict):
+        await self._cache.mset(mapping)
+        for k in mapping:
+            await self._invalidate(k)
+
+    async def pipeline(self, transaction=True):
+        """ Queue commands and send them in one round-trip on execute(), optionally as MULTI/EXEC """
+        return self._cache.pipeline(transaction=transaction)
 
+    @timed('cache')
     async def get_del(self, k):
-        return await self._cache.execute_command('GETDEL', k)
+        value = await self._cache.execute_command('GETDEL', k)
+        await self._invalidate(k)
+        return value
 
+    @timed('cache')
     async def set(self, k, v, ex=None):
         await self._cache.set(k, v, ex=ex)
+        await self._invalidate(k)
 
+    @timed('cache')
     async def delete(self, k):
         await self._cache.delete(k)
+        await self._invalidate(k)
 
+    @timed('cache')
     async def rpop(self, k):
         return await self._cache.rpop(k)
 
+    @timed('cache')
     async def rpush(self, k, v):
         await self._cache.rpush(k, v)
 
+    @timed('cache')
+    async def lpush(self, k, v):
+        await self._cache.lpush(k, v)
+
+    @timed('cache')
+    async def llen(self, k):
+        return await self._cache.llen(k)
+
+    async def brpop(self, k, timeout=0):
+        return await self._cache.brpop(k, timeout=timeout)
+
+    @timed('cache')
     async def hget(self, k1, k2):
         return await self._cache.hget(k1, k2)
 
+    @timed('cache')
+    async def hmget(self, k, *fields):
+        return await self._cache.hmget(k, *fields)
+
+    @timed('cache')
+    async def hgetall(self, k):
+        return await self._cache.hgetall(k)
+
+    @timed('cache')
     async def hset(self, k1, k2, v):
         await self._cache.hset(k1, k2, v)
+
+    def _tiers(self, tiers) -> dict:
+        """ Build one LRU per prefix from a list of {prefix, size, ttl} entries """
+        if isinstance(tiers, dict):
+            # Config.strip lowercases every mapping key, so prefixes given as keys lose their case
+            self.log.warning('redis.local should be a list of {prefix, size, ttl}; prefixes given as keys are '
+                             'lowercased and may never match')
+            tiers = [dict(prefix=prefix, **tier) for prefix, tier in tiers.items()]
+        return {tier['prefix']: LocalCache(**{k: v for k, v in tier.items() if k != 'prefix'}) for tier in tiers}
+
+    def _tier(self, k):
+        """ Find the in-process tier configured for a key, matching on the longest prefix """
+        if self._local:
+            matches = [prefix for prefix in self._local if k.startswith(prefix)]
+            if matches:
+                return self._local[max(matches, key=len)]
+
+    def _evict(self, k) -> None:
+        tier = self._tier(k)
+        if tier is not None:
+            tier.discard(k)
+            self._generation += 1
+
+    async def _invalidate(self, k) -> None:
+        """ Drop a key from the local tier here and, through pub/sub, in every other worker """
+        if self._tier(k) is not None:
+            self._evict(k)
+            await self._cache.publish(INVALIDATE, k)
+
+    async def _listen(self) -> None:
+        """ Evict keys changed by other workers, starting cold after any missed messages """
+        while True:
+            try:
+                pubsub = self._cache.pubsub()
+                await pubsub.subscribe(INVALIDATE)
+                for tier in self._local.values():
+                    tier.clear()
+                self._generation += 1
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._evict(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.error(f'Lost cache invalidation channel: {e}')
+                await asyncio.sleep(1)
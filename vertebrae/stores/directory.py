@@ -1,10 +1,14 @@
+import asyncio
+import fnmatch
 import os
 import pathlib
 from pathlib import Path
 
 import aiofiles
+from aiohttp import web
 
 from vertebrae.config import Config
+from vertebrae.metrics import timed
 
 
 class Directory:
@@ -18,22 +22,67 @@ class Directory:
         self.name = Config.find('directory', os.path.join(str(Path.home()), '.vertebrae'))
         Path(self.name).mkdir(parents=True, exist_ok=True)
 
+    @timed('directory')
     async def read(self, filename: str):
         filepath = Path(pathlib.PurePath(self.name, filename))
         async with aiofiles.open(filepath, mode='r') as f:
             return await f.read()
 
+    @timed('directory')
+    async def read_chunks(self, filename: str, chunk_size=1024 * 1024):
+        """ Read a file in chunks, without loading the whole file """
+        filepath = Path(pathlib.PurePath(self.name, filename))
+        async with aiofiles.open(filepath, mode='rb') as f:
+            while chunk := await f.read(chunk_size):
+                yield chunk
+
+    @timed('directory')
     async def walk(self, bucket: str, prefix='*'):
-        filepath = Path(pathlib.PurePath(self.name, bucket))
-        for path in Path(filepath).glob(f'{prefix}*'):
-            async with aiofiles.open(path, mode='r') as _:
-                yield os.path.basename(path)
+        subpath, _, pattern = prefix.rpartition('/')
+        filepath = Path(pathlib.PurePath(self.name, bucket, subpath))
+        for name in await asyncio.get_running_loop().run_in_executor(None, self._scan, filepath, f'{pattern}*'):
+            yield name
 
+    @staticmethod
+    def _scan(filepath: Path, pattern: str) -> list:
+        """ List the files directly inside a directory that match a pattern, without opening them """
+        try:
+            with os.scandir(filepath) as entries:
+                return sorted(entry.name for entry in entries
+                              if fnmatch.fnmatch(entry.name, pattern) and entry.is_file()
+                              and (not entry.name.startswith('.') or pattern.startswith('.')))
+        except FileNotFoundError:
+            return []
+
+    @timed('directory')
     async def write(self, filename: str, contents: str):
         filepath = Path(pathlib.PurePath(self.name, filename))
         async with aiofiles.open(filepath, mode='wb') as outfile:
             await outfile.write(contents)
 
+    @timed('directory')
+    async def write_stream(self, filename: str, chunks) -> int:
+        """ Write chunks from a sync or async iterable as they arrive, and return the bytes written """
+        filepath = Path(pathlib.PurePath(self.name, filename))
+        written = 0
+        async with aiofiles.open(filepath, mode='wb') as outfile:
+            if hasattr(chunks, '__aiter__'):
+                async for chunk in chunks:
+                    written += await outfile.write(chunk)
+            else:
+                for chunk in chunks:
+                    written += await outfile.write(chunk)
+        return written
+
+    @timed('directory')
     async def delete(self, filename: str):
         filepath = Path(pathlib.PurePath(self.name, filename))
         os.remove(filepath)
+
+    async def response(self, filename: str, chunk_size=256 * 1024, headers=None) -> web.FileResponse:
+        """ Serve a file from disk with sendfile and Range support, refusing paths outside this directory """
+        root = Path(self.name).resolve()
+        filepath = Path(pathlib.PurePath(root, filename)).resolve()
+        if root not in filepath.parents or not filepath.is_file():
+            raise web.HTTPNotFound()
+        return web.FileResponse(filepath, chunk_size=chunk_size, headers=headers)
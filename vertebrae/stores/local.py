@@ -0,0 +1,44 @@
+import collections
+import time
+
+MISSING = object()
+
+
+class LocalCache:
+    """ A bounded in-process LRU whose entries expire after a time to live """
+
+    def __init__(self, size=1024, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, k):
+        """ Return the live value for a key, or MISSING """
+        entry = self._entries.get(k)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[k]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(k)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, k, v, ttl=None) -> None:
+        self._entries[k] = (time.monotonic() + (ttl or self.ttl), v)
+        self._entries.move_to_end(k)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, k) -> None:
+        self._entries.pop(k, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return dict(size=len(self._entries), hits=self.hits, misses=self.misses, evictions=self.evictions)
@@ -1,8 +1,18 @@
+import asyncio
+import hashlib
+import io
+import re
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+
 import aiopg
 import logging
 import psycopg2
 
 from vertebrae.config import Config
+from vertebrae.metrics import Gauge, Metrics, record_error, timed
 
 
 class Relational:
@@ -10,6 +20,13 @@ class Relational:
     def __init__(self, log):
         self.log = log
         self._pool = None
+        self._dsn = None
+        self._acquire_timeout = None
+        self._buffers = dict()
+        self._prepared = weakref.WeakKeyDictionary()
+        self._waits = dict(count=0, total=0.0, max=0.0)
+        Metrics.register(Gauge('vertebrae_relational_connections', 'Pooled Postgres connections', ('state',),
+                               collect=self._connections))
 
     @staticmethod
     async def __pool_execute(pool, statement, params = None, cursor_lambda = None):
@@ -27,37 +44,249 @@ class Relational:
                    f"password={postgres['password']} "
                    f"host={postgres['host']} "
                    f"port={postgres['port']} ")
+            pool = dict(minsize=postgres.get('minsize', 0), maxsize=postgres.get('maxsize', 5),
+                        timeout=postgres.get('timeout', 10.0))
+            self._acquire_timeout = postgres.get('acquire_timeout', 10.0)
+            self._dsn = dsn + f"dbname={postgres['database']} "
             try:
-                self._pool = await aiopg.create_pool(dsn + f"dbname={postgres['database']} ",
-                                                     minsize=0, maxsize=5, timeout=10.0)
+                self._pool = await aiopg.create_pool(self._dsn, **pool)
                 await self.__pool_execute(self._pool, f"SELECT * FROM pg_database WHERE datname = '{postgres['database']};'")
             except psycopg2.OperationalError:
                 logging.debug(f"Database '{postgres['database']}' does not exist")
-                async with aiopg.create_pool(dsn, minsize=0, maxsize=5, timeout=10.0) as sys_conn:
+                async with aiopg.create_pool(dsn, minsize=0, maxsize=5, timeout=pool['timeout']) as sys_conn:
                     await self.__pool_execute(sys_conn, f"CREATE DATABASE {postgres['database']};")
                 logging.debug(f"Created database '{postgres['database']}'")
-                self._pool = await aiopg.create_pool(dsn + f"dbname={postgres['database']} ",
-                                                     minsize=0, maxsize=5, timeout=10.0)
+                self._pool = await aiopg.create_pool(self._dsn, **pool)
             with open('conf/schema.sql', 'r') as sql:
-                await self.execute(sql.read())
+                await self._apply_schema(sql.read())
 
-    async def execute(self, statement: str, params=(), return_val=False):
-        """ Run statement """
-        async def cursor_operation(cur):
-            if return_val:
-                return (await cur.fetchone())[0]
+    async def _apply_schema(self, schema: str) -> None:
+        """ Run the schema file, unless this exact version has been applied before """
+        checksum = hashlib.sha256(schema.encode('utf-8')).hexdigest()
+        try:
+            async with self._connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('CREATE TABLE IF NOT EXISTS vertebrae_schema '
+                                      '(checksum TEXT PRIMARY KEY, applied TIMESTAMP DEFAULT now())')
+                    await cur.execute('SELECT 1 FROM vertebrae_schema WHERE checksum = %s', (checksum,))
+                    if await cur.fetchone():
+                        self.log.debug('Schema unchanged, skipping conf/schema.sql')
+                        return
+                    await cur.execute(schema)
+                    await cur.execute('INSERT INTO vertebrae_schema (checksum) VALUES (%s) ON CONFLICT DO NOTHING',
+                                      (checksum,))
+        except Exception as e:
+            self.log.exception(e)
 
+    @asynccontextmanager
+    async def _connection(self):
+        """ Borrow a pooled connection, recording how long the wait took """
+        start = time.monotonic()
+        conn = await asyncio.wait_for(self._pool.acquire(), timeout=self._acquire_timeout)
+        waited = time.monotonic() - start
+        self._waits['count'] += 1
+        self._waits['total'] += waited
+        self._waits['max'] = max(self._waits['max'], waited)
         try:
-            return await self.__pool_execute(self._pool, statement, params, cursor_operation)
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+    async def _execute(self, cur, statement: str, params=(), prepare=False):
+        """ Run a statement on a cursor, through a server-side prepared statement if asked """
+        if not prepare:
+            return await cur.execute(statement, params)
+        name = f'vertebrae_{hashlib.sha1(statement.encode()).hexdigest()[:16]}'
+        prepared = self._prepared.setdefault(cur.connection, set())
+        if name not in prepared:
+            count = iter(range(1, len(params or ()) + 1))
+            body = re.sub(r'%s|%%', lambda m: f'${next(count)}' if m.group() == '%s' else '%', statement)
+            await cur.execute(f'PREPARE {name} AS {body}')
+            prepared.add(name)
+        if params:
+            return await cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+        await cur.execute(f'EXECUTE {name}')
+
+    @timed('relational')
+    async def execute(self, statement: str, params=(), return_val=False, prepare=False):
+        """ Run statement """
+        try:
+            async with self._connection() as conn:
+                async with conn.cursor() as cur:
+                    await self._execute(cur, statement, params, prepare)
+                    if return_val:
+                        return (await cur.fetchone())[0]
         except Exception as e:
             self.log.exception(e)
+            record_error('relational', 'execute')
 
-    async def fetch(self, query: str, params=()):
+    @timed('relational')
+    async def fetch(self, query: str, params=(), prepare=False):
         """ Find all matches for a query """
-        async def cursor_operation(cur):
-           return await cur.fetchall()
+        try:
+            async with self._connection() as conn:
+                async with conn.cursor() as cur:
+                    await self._execute(cur, query, params, prepare)
+                    return await cur.fetchall()
+        except Exception as e:
+            self.log.exception(e)
+            record_error('relational', 'fetch')
 
+    @timed('relational')
+    async def stream(self, query: str, params=(), batch_size=1000):
+        """ Iterate over the matches for a query, fetched in batches through a server-side cursor """
+        name = f'vertebrae_{uuid.uuid4().hex}'
         try:
-            return await self.__pool_execute(self._pool, query, params, cursor_operation)
+            async with self._connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('BEGIN')
+                    try:
+                        await cur.execute(f'DECLARE {name} NO SCROLL CURSOR FOR {query}', params)
+                        while True:
+                            await cur.execute(f'FETCH FORWARD {int(batch_size)} FROM {name}')
+                            rows = await cur.fetchall()
+                            if not rows:
+                                break
+                            for row in rows:
+                                yield row
+                    finally:
+                        await cur.execute('ROLLBACK')
         except Exception as e:
             self.log.exception(e)
+            record_error('relational', 'stream')
+
+    @timed('relational')
+    async def insert_many(self, table: str, columns: [str], rows, batch_size=1000) -> int:
+        """ Insert an iterable or async iterator of rows, one multi-row VALUES statement per batch """
+        statement = f'INSERT INTO {table} ({", ".join(columns)}) VALUES '
+        placeholders = f'({", ".join(["%s"] * len(columns))})'
+        count = 0
+        try:
+            async with self._connection() as conn:
+                async with conn.cursor() as cur:
+                    async for batch in self._batches(rows, batch_size):
+                        await cur.execute(statement + ', '.join([placeholders] * len(batch)),
+                                          [value for row in batch for value in row])
+                        count += len(batch)
+        except Exception as e:
+            self.log.exception(e)
+            record_error('relational', 'insert_many')
+        return count
+
+    @timed('relational')
+    async def copy(self, table: str, columns: [str], rows, batch_size=10000) -> int:
+        """ Load an iterable or async iterator of rows through COPY FROM STDIN in a single transaction """
+        def _copy(cur, batch):
+            buffer = io.StringIO(''.join('\t'.join(map(self._copy_value, row)) + '\n' for row in batch))
+            cur.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buffer)
+
+        # psycopg2 cannot COPY over asynchronous connections, so this uses a blocking one off the loop
+        loop = asyncio.get_running_loop()
+        count = 0
+        try:
+            conn = await loop.run_in_executor(None, psycopg2.connect, self._dsn)
+        except psycopg2.Error as e:
+            self.log.exception(e)
+            record_error('relational', 'copy')
+            return count
+        try:
+            cur = conn.cursor()
+            async for batch in self._batches(rows, batch_size):
+                await loop.run_in_executor(None, _copy, cur, batch)
+                count += len(batch)
+            await loop.run_in_executor(None, conn.commit)
+            return count
+        except Exception as e:
+            self.log.exception(e)
+            record_error('relational', 'copy')
+            return 0
+        finally:
+            await loop.run_in_executor(None, conn.close)
+
+    def buffer(self, table: str, columns: [str], max_rows=1000, interval=1.0):
+        """ Return the write-behind buffer for a table, creating it on first use """
+        if table not in self._buffers:
+            self._buffers[table] = WriteBuffer(self, table, columns, max_rows=max_rows, interval=interval)
+        return self._buffers[table]
+
+    async def close(self) -> None:
+        """ Flush write-behind buffers and close the pool """
+        for buffer in self._buffers.values():
+            await buffer.flush()
+        if self._pool:
+            self._pool.close()
+            await self._pool.wait_closed()
+
+    @staticmethod
+    async def _batches(rows, size: int):
+        batch = []
+        if hasattr(rows, '__aiter__'):
+            async for row in rows:
+                batch.append(row)
+                if len(batch) >= size:
+                    yield batch
+                    batch = []
+        else:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _copy_value(value) -> str:
+        if value is None:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def _connections(self):
+        stats = self.stats()
+        return {('in_use',): stats.get('in_use', 0), ('idle',): stats.get('idle', 0)}
+
+    def stats(self) -> dict:
+        """ Report pool usage and the time spent waiting for a connection """
+        if not self._pool:
+            return dict()
+        return dict(size=self._pool.size, in_use=self._pool.size - self._pool.freesize, idle=self._pool.freesize,
+                    minsize=self._pool.minsize, maxsize=self._pool.maxsize, waits=self._waits['count'],
+                    wait_seconds=self._waits['total'], max_wait_seconds=self._waits['max'])
+
+
+class WriteBuffer:
+    """ Collect rows in memory and insert them in batches once a size or time threshold is hit """
+
+    def __init__(self, relational: Relational, table: str, columns: [str], max_rows=1000, interval=1.0):
+        self.relational = relational
+        self.table = table
+        self.columns = columns
+        self.max_rows = max_rows
+        self.interval = interval
+        self._rows = []
+        self._timer = None
+        self._flushes = set()
+
+    def add(self, row) -> None:
+        """ Queue a row without waiting on Postgres """
+        self._rows.append(row)
+        if len(self._rows) >= self.max_rows:
+            self._flush()
+        elif not self._timer:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._flush)
+
+    async def flush(self) -> None:
+        """ Write all queued rows and wait for in-progress writes """
+        self._flush()
+        if self._flushes:
+            await asyncio.wait(set(self._flushes))
+
+    def _flush(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        rows, self._rows = self._rows, []
+        if rows:
+            task = asyncio.create_task(self.relational.insert_many(self.table, self.columns, rows, self.max_rows))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
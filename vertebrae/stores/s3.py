@@ -1,6 +1,9 @@
 import asyncio
+import collections
 import concurrent.futures
+import functools
 import logging
+import mmap
 import os
 from typing import Optional
 
@@ -8,6 +11,10 @@ import botocore
 from botocore.exceptions import ProfileNotFound, BotoCoreError
 
 from vertebrae.cloud.aws import AWS
+from vertebrae.config import Config
+from vertebrae.metrics import timed
+
+PART_SIZE = 8 * 1024 * 1024
 
 
 class S3:
@@ -16,15 +23,29 @@ class S3:
         self.log = log
         logging.getLogger('s3transfer').setLevel(logging.INFO)
         self.client = None
+        self._executor = None
 
     async def connect(self):
         """ Establish a connection to AWS """
-        self.client = AWS.client('s3')
+        connections = (Config.find('aws') or {}).get('max_pool_connections', 10)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections,
+                                                               thread_name_prefix='vertebrae-s3')
+        self.client = AWS.client('s3', max_pool_connections=connections)
+
+    async def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args, **kwargs):
+        """ Run a blocking boto3 call on the shared S3 executor """
+        return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                 functools.partial(func, *args, **kwargs))
 
+    @timed('s3')
     async def exists(self, bucket: str, object: str):
         """ Check if a file exists """
         try:
-            self.client.head_object(Bucket=bucket, Key=object)
+            await self._run(self.client.head_object, Bucket=bucket, Key=object)
             return True
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == '404':
@@ -32,16 +53,35 @@ class S3:
             else:
                 self.log.error(f'Error looking up {object}')
 
+    @timed('s3')
     async def read(self, filename: str) -> str:
         """ Read file from S3 """
         bucket, key = filename.split('/', 1)
         try:
-            body = self.client.get_object(Bucket=bucket, Key=key)
-            return body['Body'].read()
+            body = await self._run(self.client.get_object, Bucket=bucket, Key=key)
+            return await self._run(body['Body'].read)
+        except self.client.exceptions.NoSuchKey:
+            self.log.error(f'Missing {key}')
+        except botocore.exceptions.ClientError:
+            self.log.error(f'Missing {key}')
+
+    @timed('s3')
+    async def read_stream(self, filename: str, chunk_size=1024 * 1024):
+        """ Read file from S3 in chunks, without buffering the whole object """
+        bucket, key = filename.split('/', 1)
+        try:
+            body = (await self._run(self.client.get_object, Bucket=bucket, Key=key))['Body']
         except self.client.exceptions.NoSuchKey:
             self.log.error(f'Missing {key}')
+            return
         except botocore.exceptions.ClientError:
             self.log.error(f'Missing {key}')
+            return
+        try:
+            while chunk := await self._run(body.read, chunk_size):
+                yield chunk
+        finally:
+            body.close()
 
     def download_file(self, filename: str, dst: str):
         bucket, key = filename.split('/', 1)
@@ -57,51 +97,238 @@ class S3:
         except FileNotFoundError:
             self.log.error(f'Missing {src}')
 
+    @timed('s3')
+    async def upload(self, src, filename: str, part_size=PART_SIZE, concurrency=4, progress=None, upload_id=None):
+        """ Upload a local file, bytes or an async iterator of bytes to S3 in parallel parts """
+        bucket, key = filename.split('/', 1)
+        if isinstance(src, (bytes, bytearray)):
+            if not src:
+                return await self.write(filename, b'')
+            return await self._upload(bucket, key, self._slices(src, part_size), len(src),
+                                      part_size, concurrency, progress, upload_id)
+        if not isinstance(src, str):
+            return await self._upload(bucket, key, self._chunks(src, part_size), None,
+                                      part_size, concurrency, progress, upload_id)
+        try:
+            with open(src, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return await self.write(filename, b'')
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    await self._upload(bucket, key, self._slices(mapped, part_size), len(mapped),
+                                       part_size, concurrency, progress, upload_id)
+        except FileNotFoundError:
+            self.log.error(f'Missing {src}')
+
+    @timed('s3')
+    async def download(self, filename: str, dst: str, part_size=PART_SIZE, concurrency=4, progress=None):
+        """ Download a file from S3 to a local path in parallel ranged parts """
+        bucket, key = filename.split('/', 1)
+        try:
+            size = (await self._run(self.client.head_object, Bucket=bucket, Key=key))['ContentLength']
+        except botocore.exceptions.ClientError:
+            self.log.error(f'Missing {key}')
+            return
+        received = 0
+
+        def _fetch(fd, start):
+            body = self._range(bucket, key, start, min(start + part_size, size) - 1)
+            os.pwrite(fd, body, start)
+            return len(body)
+
+        async def _part(fd, start):
+            nonlocal received
+            received += await self._run(_fetch, fd, start)
+            if progress:
+                progress(received, size)
+
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            await self._bounded(self._iterate(_part(fd, start) for start in range(0, size, part_size)), concurrency)
+        finally:
+            os.close(fd)
+
+    @timed('s3')
+    async def read_parts(self, filename: str, part_size=PART_SIZE, concurrency=4):
+        """ Read file from S3 as ordered parts, fetching up to `concurrency` ranges ahead """
+        bucket, key = filename.split('/', 1)
+        try:
+            size = (await self._run(self.client.head_object, Bucket=bucket, Key=key))['ContentLength']
+        except botocore.exceptions.ClientError:
+            self.log.error(f'Missing {key}')
+            return
+        window = collections.deque()
+        try:
+            for start in range(0, size, part_size):
+                window.append(asyncio.ensure_future(
+                    self._run(self._range, bucket, key, start, min(start + part_size, size) - 1)))
+                if len(window) >= concurrency:
+                    yield await window.popleft()
+            while window:
+                yield await window.popleft()
+        finally:
+            for task in window:
+                task.cancel()
+
+    def _range(self, bucket: str, key: str, start: int, end: int) -> bytes:
+        return self.client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}')['Body'].read()
+
+    async def _upload(self, bucket, key, parts, total, part_size, concurrency, progress, upload_id):
+        """ Send parts as a multipart upload, skipping any already stored under a resumed upload_id """
+        if total is not None and total <= part_size and not upload_id:
+            async for _, _, body in parts:
+                await self._run(lambda: self.client.put_object(Body=body() if callable(body) else body,
+                                                               Bucket=bucket, Key=key))
+            if progress:
+                progress(total, total)
+            return
+
+        uploaded = dict()
+        if upload_id:
+            listing = dict(Bucket=bucket, Key=key, UploadId=upload_id)
+            while True:
+                page = await self._run(self.client.list_parts, **listing)
+                uploaded.update({p['PartNumber']: p['ETag'] for p in page.get('Parts', [])})
+                if not page.get('IsTruncated'):
+                    break
+                listing['PartNumberMarker'] = page['NextPartNumberMarker']
+        else:
+            upload_id = (await self._run(self.client.create_multipart_upload, Bucket=bucket, Key=key))['UploadId']
+        sent = 0
+
+        def _put(number, body):
+            return self.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                           Body=body() if callable(body) else body)['ETag']
+
+        async def _part(number, size, body):
+            nonlocal sent
+            if number not in uploaded:
+                uploaded[number] = await self._run(_put, number, body)
+            sent += size
+            if progress:
+                progress(sent, total)
+
+        async def _jobs():
+            async for number, size, body in parts:
+                yield _part(number, size, body)
+
+        try:
+            await self._bounded(_jobs(), concurrency)
+            await self._run(self.client.complete_multipart_upload, Bucket=bucket, Key=key, UploadId=upload_id,
+                            MultipartUpload=dict(Parts=[dict(PartNumber=n, ETag=uploaded[n]) for n in sorted(uploaded)]))
+        except Exception:
+            self.log.error(f'Failed upload of {key}, resume with upload_id={upload_id}')
+            raise
+
+    @staticmethod
+    async def _slices(buffer, part_size: int):
+        """ Split a buffer into parts, copying each slice only when it is sent """
+        for number, start in enumerate(range(0, len(buffer), part_size), start=1):
+            end = min(start + part_size, len(buffer))
+            yield number, end - start, functools.partial(buffer.__getitem__, slice(start, end))
+
+    @staticmethod
+    async def _chunks(source, part_size: int):
+        """ Regroup an async iterator of bytes into parts """
+        number, buffer = 1, bytearray()
+        async for chunk in source:
+            buffer.extend(chunk)
+            while len(buffer) >= part_size:
+                part = bytes(buffer[:part_size])
+                del buffer[:part_size]
+                yield number, len(part), part
+                number += 1
+        if buffer or number == 1:
+            yield number, len(buffer), bytes(buffer)
+
+    @staticmethod
+    async def _iterate(jobs):
+        for job in jobs:
+            yield job
+
+    @staticmethod
+    async def _bounded(jobs, concurrency: int) -> None:
+        """ Run coroutines from an async iterator with at most `concurrency` in flight """
+        tasks = set()
+        try:
+            async for job in jobs:
+                tasks.add(asyncio.ensure_future(job))
+                while len(tasks) >= concurrency:
+                    done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+            if tasks:
+                done, tasks = await asyncio.wait(tasks)
+                for task in done:
+                    task.result()
+        except BaseException:
+            if tasks:
+                await asyncio.wait(tasks)
+            raise
+
+    @timed('s3')
     async def write(self, filename: str, contents: str) -> None:
         """ Write file to S3 """
         bucket, key = filename.split('/', 1)
-        self.client.put_object(Body=contents, Bucket=bucket, Key=key)
+        await self._run(self.client.put_object, Body=contents, Bucket=bucket, Key=key)
 
+    @timed('s3')
     async def delete(self, filename: str) -> None:
         """ Delete file from S3 """
         bucket, key = filename.split('/', 1)
-        self.client.delete_object(Bucket=bucket, Key=key)
+        await self._run(self.client.delete_object, Bucket=bucket, Key=key)
 
-    async def walk(self, bucket: str, prefix: str) -> [str]:
+    async def _objects(self, bucket: str, prefix: str):
+        """ Page through every object under a prefix """
+        params = dict(Bucket=bucket, Prefix=prefix)
+        while True:
+            page = await self._run(self.client.list_objects_v2, **params)
+            for obj in page.get('Contents', []):
+                yield obj
+            if not page.get('IsTruncated'):
+                return
+            params['ContinuationToken'] = page['NextContinuationToken']
+
+    @timed('s3')
+    async def walk(self, bucket: str, prefix: str):
         """ Get all files of S3 bucket """
         try:
-            obj_list = self.client.list_objects_v2(Bucket=bucket, Prefix=prefix).get('Contents', [])
-            return [f['Key'] for f in obj_list]
+            async for obj in self._objects(bucket=bucket, prefix=prefix):
+                yield obj['Key']
         except botocore.exceptions.ConnectionClosedError:
             self.log.error('Failed connection to AWS S3')
 
-    async def read_all(self, bucket: str, prefix: str) -> [str]:
-        """ Read all contents of S3 bucket """
-        def _retrieve(k):
+    @timed('s3')
+    async def read_all(self, bucket: str, prefix: str, concurrency=10, max_bytes=64 * 1024 * 1024):
+        """ Read all contents of S3 bucket, yielding (name, contents) as each download completes """
+        async def _retrieve(k):
             try:
-                cfg = self.client.get_object(Bucket=bucket, Key=k)
-                return k, cfg['Body'].read()
+                cfg = await self._run(self.client.get_object, Bucket=bucket, Key=k)
+                return k, await self._run(cfg['Body'].read)
             except Exception:
-                return None
+                return k, None
 
-        my_files = dict()
+        pending, in_flight = dict(), 0
         try:
-            files = await self.walk(bucket=bucket, prefix=prefix)
-            if not files:
-                return my_files
-
-            tasks = []
-            executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
-            for f in files:
-                tasks.append(asyncio.get_event_loop().run_in_executor(executor, _retrieve, f))
-            completed, pending = await asyncio.wait(tasks)
-            for task in completed:
-                key, contents = task.result()
+            async for obj in self._objects(bucket=bucket, prefix=prefix):
+                while pending and (len(pending) >= concurrency or in_flight + obj['Size'] > max_bytes):
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        in_flight -= pending.pop(task)
+                        key, contents = task.result()
+                        if contents:
+                            yield os.path.basename(key), contents
+                pending[asyncio.create_task(_retrieve(obj['Key']))] = obj['Size']
+                in_flight += obj['Size']
+            for task in asyncio.as_completed(pending):
+                key, contents = await task
                 if contents:
-                    my_files[os.path.basename(key)] = contents
-            return my_files
+                    yield os.path.basename(key), contents
         except botocore.exceptions.ConnectionClosedError:
             self.log.error('Failed connection to AWS S3')
+        finally:
+            for task in pending:
+                task.cancel()
 
     def redirect_url(self, bucket: str, object_name: str, expires_in=60) -> Optional[str]:
         """ Generate a time-bound redirect URL to a specific file in a bucket """
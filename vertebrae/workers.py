@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+
+class Worker:
+    """ Concurrent consumers of a Redis list queue, with retries, dead-lettering and a graceful stop """
+
+    def __init__(self, queue: str, handle, concurrency=1, retries=3, backoff=1.0, dead_letter=None, maxlen=None,
+                 poll=1):
+        self.queue = queue
+        self.handle = handle
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.dead_letter = dead_letter
+        self.maxlen = maxlen
+        self.poll = poll
+        self.log = logging.getLogger(f'vertebrae.worker.{queue}')
+        self._cache = None
+        self._consumers = []
+        self._stopping = False
+
+    async def start(self, cache) -> None:
+        """ Launch the consumers """
+        self._cache = cache
+        self._stopping = False
+        self._consumers = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout=30) -> None:
+        """ Stop fetching, and give in-flight jobs `timeout` seconds to finish before cancelling them """
+        self._stopping = True
+        if not self._consumers:
+            return
+        _, pending = await asyncio.wait(self._consumers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._consumers = []
+
+    async def put(self, job: str, cache=None) -> None:
+        """ Queue a job, waiting while the queue holds maxlen jobs """
+        cache = cache or self._cache
+        while self.maxlen and await cache.llen(self.queue) >= self.maxlen:
+            await asyncio.sleep(self.poll / 10)
+        await cache.lpush(self.queue, job)
+
+    async def _consume(self) -> None:
+        while not self._stopping:
+            try:
+                popped = await self._cache.brpop(self.queue, timeout=self.poll)
+            except Exception as e:
+                self.log.error(f'Failed to fetch from {self.queue}: {e}')
+                await asyncio.sleep(self.poll)
+                continue
+            if popped:
+                await self._process(popped[1])
+
+    async def _process(self, job: str) -> None:
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await self.handle(job)
+                except Exception as e:
+                    if attempt == self.retries:
+                        self.log.exception(f'Job failed after {attempt + 1} attempts: {e}')
+                        break
+                    self.log.warning(f'Job failed, retrying: {e}')
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+        except asyncio.CancelledError:
+            await self._cache.rpush(self.queue, job)
+            raise
+        if self.dead_letter:
+            await self._cache.rpush(self.dead_letter, job)